@@ -6,18 +6,39 @@ from os.path import dirname, join
 import re
 import signal
 import pickle
+import queue
+import json
+import time
+import atexit
+import hashlib
 import logging
+import logging.handlers
 import subprocess
-from functools import reduce, lru_cache
-from collections import namedtuple
+import weakref
+import _thread
+from functools import reduce, lru_cache, partial
+from collections import namedtuple, deque, Counter
 from itertools import islice, count, repeat
 from importlib import import_module
+from importlib.util import find_spec
+from importlib.machinery import PathFinder
 
 REAL_EXIT = sys.exit
 
 __version__ = '0.1.0'
 
-SCENARIO_FORMAT_VERSION = 1
+SCENARIO_FORMAT_VERSION = 2
+# Max log records waiting for the writer thread; the rest below WARNING are dropped
+LOG_QUEUE_SIZE = 10000
+CACHE_DIR = join(os.environ.get('XDG_CACHE_HOME',
+                                join(os.path.expanduser('~'), '.cache')),
+                 'pyqttester')
+# Environment variable by which --x11 passes the result cache key to the child
+RESULT_KEY_ENV = 'PYQTTESTER_RESULT_KEY'
+# Exit status when the app stalls for longer than --stall-timeout
+EXIT_STALL = 4
+# Max number of events in a replayed batch if --batch doesn't specify it
+DEFAULT_BATCH_SIZE = 100
 X11_SHELL_SCRIPT = open(join(dirname(__file__), 'x11_subprocess.sh')).read()
 
 log = logging.getLogger(__name__)
@@ -25,6 +46,34 @@ log = logging.getLogger(__name__)
 # Forward declared
 QtGui, QtCore, QWidget, Qt, qApp, QT_KEYS, EVENT_TYPE = repeat(None, 7)
 
+# Whether we're used as a library (see record(), replay()) rather than
+# from the command line, i.e. whether we mustn't exit the process
+_library_mode = False
+
+
+class PyQtTesterError(Exception):
+    """Raised with the would-be exit status instead of exiting the process
+    when PyQtTester is used as a library"""
+    MESSAGES = {
+        0: 'skipped',
+        1: 'invalid arguments',
+        2: 'unhandled exception in the app',
+        3: 'object to replay the event on not found',
+        EXIT_STALL: 'the app stalled',
+    }
+
+    def __init__(self, status):
+        super().__init__('{} (exit status {})'.format(
+            self.MESSAGES.get(status, 'failed'), status))
+        self.status = status
+
+
+def _terminate(status):
+    """Exit the process, or raise PyQtTesterError if used as a library"""
+    if _library_mode:
+        raise PyQtTesterError(status)
+    REAL_EXIT(status)
+
 
 def deepgetattr(obj, attr):
     """Recurses through an attribute chain to get the ultimate value."""
@@ -41,8 +90,50 @@ def typed_nth(n, target_type, iterable, default=None):
     return nth(n, (i for i in iterable if type(i) == target_type), default)
 
 
-def parse_args():
+def event_type_name(event):
+    """Return the name of event's QEvent.Type, e.g. 'MouseButtonPress'"""
+    return EVENT_TYPE.get(event.type(), 'Unknown(type=' + str(event.type()) + ')')
+
+
+def stop_logging():
+    """Flush the log records queued since init_logging() and stop the writer"""
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    A QueueHandler that doesn't block the calling (GUI) thread on I/O.
+    Records are formatted in the calling thread (their arguments, e.g.
+    widgets, mustn't be touched from another thread) and written in the
+    writer thread. Records below WARNING that don't fit into the bounded
+    queue are dropped and counted.
+    """
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        if record.levelno >= logging.WARNING:
+            # Never lose warnings and errors; wait for the writer instead
+            self.queue.put(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class _QueueListener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self):
+        # Block, if need be, to not lose the sentinel when the queue is full
+        self.queue.put(self._sentinel)
+
+
+def parse_args(argv=None):
+    import shlex
     from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+    from .distributed import parse_address
+    from .timings import METRICS
+    from .soak import Soak
     argparser = ArgumentParser(
         description='A tool for testing PyQt GUI applications by recording '
                     'and replaying scenarios.',
@@ -71,6 +162,20 @@ def parse_args():
         'explain',
         formatter_class=ArgumentDefaultsHelpFormatter,
         help='Explain in semi-human-readable form the events scenario contains.')
+    parser_coordinate = subparsers.add_parser(
+        'coordinate',
+        formatter_class=ArgumentDefaultsHelpFormatter,
+        help='Serve scenario replay jobs to workers (possibly on other hosts) '
+             'and collect their results.')
+    parser_compare = subparsers.add_parser(
+        'compare',
+        formatter_class=ArgumentDefaultsHelpFormatter,
+        help='Compare recent replay timings of scenarios against their '
+             'earlier replays and report performance regressions.')
+    parser_work = subparsers.add_parser(
+        'work',
+        formatter_class=ArgumentDefaultsHelpFormatter,
+        help='Pull scenario replay jobs from the coordinator and run them.')
 
     # TODO: default try to figure out Qt version by grepping entry-point
     args, kwargs = (
@@ -110,6 +215,14 @@ def parse_args():
     parser_record.add_argument(
         '--events-exclude', metavar='REGEX',
         help="When recording, skip events that match the filter.")
+    parser_record.add_argument(
+        '--flight-events', metavar='N', type=int,
+        help='Flight-recorder mode: keep only the last N recorded events. '
+             'The scenario is written on exit, on unhandled exception, '
+             'and whenever the process receives SIGUSR1.')
+    parser_record.add_argument(
+        '--flight-minutes', metavar='T', type=float,
+        help='Flight-recorder mode: keep only the events of the last T minutes.')
     parser_record.add_argument( # TODO
         '--objects-include', metavar='REGEX',
         help='When recording, record only events on objects that match the filter.')
@@ -127,24 +240,172 @@ def parse_args():
     parser_replay.add_argument( # TODO
         '--coverage', action='store_true',
         help='Run the coverage analysis simultaneously.')
+    parser_replay.add_argument(
+        '--batch', metavar='TYPE[:MAX],...', default='KeyPress,KeyRelease,MouseMove',
+        help='When replaying, dispatch runs of consecutive events of these '
+             'QEvent types on the same object in a single batch (of at most '
+             'MAX events, default {}) without waiting for the app to settle '
+             "in between. Use '' to dispatch events one by one."
+             .format(DEFAULT_BATCH_SIZE))
+    parser_replay.add_argument(
+        '--repeat', metavar='N', type=int,
+        help='Soak test: replay the scenario(s) N times in a loop inside the '
+             'same app instance, reporting memory growth and latency drift. '
+             'The scenarios must end in the state they started in.')
+    parser_replay.add_argument(
+        '--duration', metavar='SECONDS', type=float,
+        help='Soak test: keep replaying the scenario(s) in a loop for this long.')
+    parser_replay.add_argument(
+        '--soak-scenario', metavar='SCENARIO', action='append', default=[],
+        help='Soak test: additional scenario to replay in each iteration.')
+    parser_replay.add_argument(
+        '--shuffle', action='store_true',
+        help='Soak test: replay the scenarios in random order in each iteration.')
+    parser_replay.add_argument(
+        '--seed', metavar='SEED', type=int,
+        help='Soak test: the random seed for --shuffle.')
+    parser_replay.add_argument(
+        '--stall-threshold', metavar='SECONDS', type=float, default=2,
+        help='When the app stops processing events for this long, sample '
+             "and report the main thread's stack (0 to disable).")
+    parser_replay.add_argument(
+        '--stall-sample-rate', metavar='HZ', type=float, default=50,
+        help='How often to sample the stack of a stalled app.')
+    parser_replay.add_argument(
+        '--stall-timeout', metavar='SECONDS', type=float, default=120,
+        help='Abort with exit status {} when the app is stalled for this long. '
+             'When used as a library, the stalled main thread is interrupted '
+             'instead, which takes effect only once it runs Python code.'
+             .format(EXIT_STALL))
+    parser_replay.add_argument(
+        '--no-cache', action='store_true',
+        help='Replay the scenario even if it passed before with unchanged '
+             'scenario, app sources, PyQt version and arguments.')
+    parser_replay.add_argument(
+        '--cache-dir', metavar='DIR', default=CACHE_DIR,
+        help='The directory of the replay result cache.')
+    parser_replay.add_argument(
+        '--cache-size', metavar='BYTES', type=int, default=10 * 2**20,
+        help='Evict least recently used results above this cache size.')
 
-    args = argparser.parse_args()
+    args, kwargs = (
+        ('--timings',),
+        dict(metavar='FILE', default=join(CACHE_DIR, 'timings.sqlite'),
+             help='The SQLite timing store replays append their timings to '
+                  "(use '' to disable)."))
+    parser_replay.add_argument(*args, **kwargs)
+    parser_compare.add_argument(*args, **kwargs)
+
+    parser_compare.add_argument(
+        '--metric', default='latency_p90', choices=METRICS,
+        help='The metric to compare.')
+    parser_compare.add_argument(
+        '--recent', metavar='N', type=int, default=1,
+        help='Compare the median of the last N replays ...')
+    parser_compare.add_argument(
+        '--baseline', metavar='N', type=int, default=10,
+        help='... against the median of the N replays before them.')
+    parser_compare.add_argument(
+        '--threshold', metavar='K', type=float, default=3,
+        help='Flag changes larger than K robust standard deviations '
+             '(scaled MAD) of the baseline ...')
+    parser_compare.add_argument(
+        '--min-change', metavar='FRACTION', type=float, default=.1,
+        help='... and larger than FRACTION of the baseline median.')
+    parser_compare.add_argument(
+        '--junit', metavar='FILE',
+        help='Write the results as JUnit XML into FILE.')
+    parser_compare.add_argument(
+        'scenarios', metavar='SCENARIO', nargs='*',
+        help='The scenarios to compare, by file name (default: all in the '
+             'timing store). Each Qt version is compared separately.')
+
+    parser_coordinate.add_argument(
+        '--bind', metavar='HOST:PORT', default='localhost:18642',
+        help='The address to serve the jobs on.')
+    parser_coordinate.add_argument(
+        '--qt', metavar='QT_VERSIONS', default='5',
+        help='The versions of PyQt to replay each scenario with (e.g. 45 for both).')
+    parser_coordinate.add_argument(
+        '--replay-args', metavar='ARGS', action='append',
+        help='Additional arguments for replay (e.g. --replay-args=--x11). If given '
+             'multiple times, each scenario is replayed with each of them.')
+    parser_coordinate.add_argument(
+        '--retries', metavar='N', type=int, default=2,
+        help="Retry a job up to N times if its worker fails.")
+    parser_coordinate.add_argument(
+        '--lease-timeout', metavar='SECONDS', type=float, default=60,
+        help='Consider a worker failed if it sends no heartbeat for this long.')
+    parser_coordinate.add_argument(
+        '--results-dir', metavar='DIR', default='pyqttester-results',
+        help='Save job logs and artifacts into DIR.')
+    parser_coordinate.add_argument(
+        'main', metavar='MODULE_PATH',
+        help='The application entry point (module.path.to:main function), '
+             'importable on the worker hosts.')
+    parser_coordinate.add_argument(
+        'scenarios', metavar='SCENARIO', nargs='+',
+        help='The scenario files.')
+    parser_coordinate.add_argument(
+        '--args', metavar='ARGS', default='',
+        help='Additional arguments to pass to the app as sys.argv '
+             '(e.g. --args="--foo bar").')
+
+    parser_work.add_argument(
+        '--command', metavar='COMMAND', default='PyQtTester',
+        help='The command to run replays with.')
+    parser_work.add_argument(
+        '--connect-timeout', metavar='SECONDS', type=float, default=60,
+        help='Give up if the coordinator is unreachable for this long at start.')
+    parser_work.add_argument(
+        'coordinator', metavar='HOST:PORT',
+        help='The address of the coordinator.')
+
+    args = argparser.parse_args(argv)
 
     def init_logging(verbose=0, log_file=None):
+        global stop_logging
+        # The handlers' I/O runs in a background writer thread; the GUI
+        # thread only formats the records and puts them into a bounded queue
         formatter = logging.Formatter('%(relativeCreated)d %(levelname)s: %(message)s')
-        for handler in (logging.StreamHandler(),
-                        log_file and logging.FileHandler(log_file, 'w', encoding='utf-8')):
-            if handler:
-                handler.setFormatter(formatter)
-                log.addHandler(handler)
+        handlers = [handler
+                    for handler in (logging.StreamHandler(),
+                                    log_file and logging.FileHandler(log_file, 'w', encoding='utf-8'))
+                    if handler]
+        for handler in handlers:
+            handler.setFormatter(formatter)
+        queue_handler = _DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+        listener = _QueueListener(queue_handler.queue, *handlers)
+        log.addHandler(queue_handler)
         log.setLevel(logging.WARNING - 10 * verbose)
-
-    init_logging(args.verbose or 0, args.log)
+        listener.start()
+
+        def stop_logging():
+            # Later records mustn't wait for the stopped writer
+            log.removeHandler(queue_handler)
+            listener.stop()
+            if queue_handler.dropped:
+                record = log.makeRecord(
+                    log.name, logging.WARNING, __file__, 0,
+                    '%d log records were dropped because the log queue was full',
+                    (queue_handler.dropped,), None)
+                for handler in handlers:
+                    handler.handle(record)
+            for handler in handlers:
+                handler.flush()
+
+        atexit.register(stop_logging)
+
+    if _library_mode:
+        # Leave the output to the host application's logging configuration
+        log.setLevel(logging.WARNING - 10 * (args.verbose or 0))
+    else:
+        init_logging(args.verbose or 0, args.log)
     log.info('Program arguments: %s', args)
 
     def _error(*args, **kwargs):
         log.error(*args, **kwargs)
-        REAL_EXIT(1)
+        _terminate(1)
 
     def _is_command_available(command):
         try:
@@ -154,6 +415,7 @@ def parse_args():
             return False
 
     def _check_main(args):
+        args.entry_point = args.main
 
         def _main(entry_point=args.main):
             # Make the application believe it was run unpatched
@@ -203,7 +465,39 @@ def parse_args():
         except (IOError, OSError) as e:
             _error('explain %s: %s', args.scenario, e)
 
+    def check_coordinate(args):
+        if not args.qt or set(args.qt) - set('45'):
+            _error('QT_VERSIONS must be a combination of 4 and 5')
+        scenarios = []
+        for scenario in args.scenarios:
+            try:
+                with open(scenario, 'rb') as file:
+                    scenarios.append((scenario, file.read()))
+            except (IOError, OSError) as e:
+                _error('coordinate %s: %s', scenario, e)
+        args.scenarios = scenarios
+        args.args = shlex.split(args.args)
+        try:
+            parse_address(args.bind)
+        except ValueError:
+            _error('--bind address must be like HOST:PORT')
+
+    def check_work(args):
+        try:
+            parse_address(args.coordinator)
+        except ValueError:
+            _error('coordinator address must be like HOST:PORT')
+
+    def check_compare(args):
+        if args.recent < 1 or args.baseline < 2:
+            _error('compare needs --recent >= 1 and --baseline >= 2')
+        if not os.path.isfile(args.timings):
+            _error('compare: no timing store %s', args.timings)
+
     def check_record(args):
+        if ((args.flight_events is not None and args.flight_events < 1) or
+                (args.flight_minutes is not None and args.flight_minutes <= 0)):
+            _error('--flight-events and --flight-minutes must be positive')
         _check_main(args)
         _global_qt(args)
         try:
@@ -212,12 +506,44 @@ def parse_args():
             _error('record %s: %s', args.scenario, e)
 
     def check_replay(args):
+        if _library_mode and (args.x11 or args.x11_video):
+            _error('--x11 and --x11-video re-run the whole process in Xvfb and '
+                   "can't be used from the library API; run it in a headless "
+                   'X11 server instead (e.g. pytest --pyqttester-x11)')
+        if args.stall_threshold < 0 or args.stall_sample_rate <= 0:
+            _error('--stall-threshold must be >= 0 and --stall-sample-rate > 0')
+        if args.stall_threshold and args.stall_timeout < args.stall_threshold:
+            _error('--stall-timeout must be at least --stall-threshold')
         _check_main(args)
         _global_qt(args)
         try:
             args.scenario = open(args.scenario, 'rb')
         except (IOError, OSError) as e:
             _error('replay %s: %s', args.scenario, e)
+        batch_policy = {}
+        for item in filter(None, args.batch.split(',')):
+            event_type, _, size = item.partition(':')
+            try:
+                size = int(size or DEFAULT_BATCH_SIZE)
+            except ValueError:
+                _error('--batch sizes must be integers: %s', item)
+            if not isinstance(getattr(QtCore.QEvent, event_type, None), int):
+                _error('--batch: unknown QEvent type: %s', event_type)
+            batch_policy[event_type] = size
+        args.batch = batch_policy
+        args.soak = None
+        if args.repeat or args.duration:
+            files = args.soak_files = [args.scenario]
+            for scenario in args.soak_scenario:
+                try:
+                    files.append(open(scenario, 'rb'))
+                except (IOError, OSError) as e:
+                    _error('replay --soak-scenario %s: %s', scenario, e)
+            args.soak = Soak(files, args.repeat, args.duration,
+                             args.shuffle, args.seed)
+        elif args.soak_scenario or args.shuffle:
+            log.warning('--soak-scenario and --shuffle only apply '
+                        'with --repeat or --duration')
         # TODO: https://coverage.readthedocs.org/en/coverage-4.0.2/api.html#api
         #       https://nose.readthedocs.org/en/latest/plugins/cover.html#source
         if args.x11_video:
@@ -229,6 +555,24 @@ def parse_args():
                 args.x11 = True
             if args.x11_video is True:
                 args.x11_video = args.scenario.name + '.mp4'
+        args.result_cache = args.result_key = None
+        # Don't skip runs that are expected to produce a video or soak reports
+        if not args.no_cache and not args.x11_video and not args.soak:
+            args.result_cache = ResultCache(args.cache_dir, args.cache_size)
+            result_key = os.environ.pop(RESULT_KEY_ENV, None)
+            if result_key is None:
+                result_key = replay_cache_key(args)
+                if result_key in args.result_cache:
+                    log.warning('Scenario %s passed before with the same inputs. '
+                                'Skipping (use --no-cache to replay anyway).',
+                                args.scenario.name)
+                    _terminate(0)
+            args.result_key = result_key or None
+        if args.timings:
+            try:
+                os.makedirs(dirname(os.path.abspath(args.timings)), exist_ok=True)
+            except OSError as e:
+                _error('replay --timings %s: %s', args.timings, e)
         if args.x11:
             for xvfb in ('Xvfb', '/usr/X11/bin/Xvfb'):
                 if _is_command_available(xvfb):
@@ -245,9 +589,7 @@ def parse_args():
 
             log.info('Re-running head-less in Xvfb.')
             # Prevent recursion
-            for arg in ('--x11', '--x11-video'):
-                if arg in sys.argv:
-                    sys.argv.remove(arg)
+            argv = [arg for arg in sys.argv if arg not in ('--x11', '--x11-video')]
 
             from random import randint
             from hashlib import md5
@@ -262,22 +604,163 @@ def parse_args():
                 MCOOKIE=md5(os.urandom(30)).hexdigest(),
                 DISPLAY=next(i for i in (randint(111, 10000) for _ in repeat(0))
                              if not os.path.exists('/tmp/.X{}-lock'.format(i))),
-                ARGV=' '.join(sys.argv))
-            REAL_EXIT(subprocess.call(X11_SHELL_SCRIPT,
-                                      shell=True,
-                                      stdout=sys.stderr,
-                                      env=env))
+                ARGV=' '.join(argv))
+            env[RESULT_KEY_ENV] = args.result_key or ''
+            _terminate(subprocess.call(X11_SHELL_SCRIPT,
+                                       shell=True,
+                                       stdout=sys.stderr,
+                                       env=env))
 
     try:
         dict(record=check_record,
              replay=check_replay,
-             explain=check_explain)[args._subcommand](args)
+             explain=check_explain,
+             compare=check_compare,
+             coordinate=check_coordinate,
+             work=check_work)[args._subcommand](args)
     except KeyError:
         return REAL_EXIT(argparser.format_help())
+    except BaseException:
+        # Unlike the process, the opened files live on when used as a library
+        _close_files(args)
+        raise
     return args
 
 
+def _close_files(args):
+    """Close the scenario file(s) opened by parse_args()"""
+    for file in [getattr(args, 'scenario', None)] + getattr(args, 'soak_files', []):
+        if hasattr(file, 'close'):
+            file.close()
+
+
+def _find_spec(module):
+    """Like find_spec(), but without importing the parent packages, as
+    the app mustn't be imported before its QApplication is patched"""
+    parts = module.split('.')
+    spec = find_spec(parts[0])
+    for i in range(1, len(parts)):
+        if spec is None or not spec.submodule_search_locations:
+            return None
+        spec = PathFinder.find_spec('.'.join(parts[:i + 1]),
+                                    list(spec.submodule_search_locations))
+    return spec
+
+
+def _hash_module_source(digest, module):
+    """Update digest with source of module, or whole package if module is
+    a package. Raise ImportError if module can't be found."""
+    spec = _find_spec(module)
+    if spec is None or not (spec.origin or spec.submodule_search_locations):
+        raise ImportError(module)
+    paths = []
+    for location in spec.submodule_search_locations or ():
+        for dirpath, _, filenames in os.walk(location):
+            paths.extend(join(dirpath, f) for f in filenames if f.endswith('.py'))
+    if not paths and os.path.isfile(spec.origin):
+        paths.append(spec.origin)
+    for path in sorted(paths):
+        digest.update(path.encode())
+        with open(path, 'rb') as file:
+            digest.update(file.read())
+
+
+def replay_cache_key(args):
+    """
+    Return a key that identifies the replay result: a hash of the scenario,
+    the source of the app modules it touches (or the whole app package
+    if that is unknown), the PyQt version and the relevant arguments.
+    Return '' if the key can't be reliably determined.
+    """
+    digest = hashlib.sha256()
+    scenario = args.scenario.read()
+    args.scenario.seek(0)
+    digest.update(scenario)
+    digest.update(repr((__version__,
+                        QtCore.PYQT_VERSION_STR,
+                        QtCore.QT_VERSION_STR,
+                        args.qt,
+                        args.entry_point,
+                        args.args,
+                        args.x11,
+                        sorted(args.batch.items()))).encode())
+    entry_module = args.entry_point.partition(':')[0]
+    try:
+        obj_cache = split_scenario(pickle.loads(scenario))[0]
+    except Exception:
+        obj_cache = None
+    modules = obj_cache and {
+        el.type.partition(':')[0]
+        for path in obj_cache.values()
+        for el in path}
+    if not modules or '' in modules:
+        # Types in scenario unknown or not reversible; use the whole package
+        modules = {entry_module.partition('.')[0]}
+    modules = sorted(module for module in modules | {entry_module}
+                     if not module.startswith(('PyQt4.', 'PyQt5.', 'sip')))
+    try:
+        for module in modules:
+            _hash_module_source(digest, module)
+    except (ImportError, ValueError, OSError) as e:
+        log.info("Can't determine source of app modules (%s); "
+                 "not using result cache", e)
+        return ''
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    Local directory of passed replays, keyed by replay_cache_key(), with
+    least-recently-used eviction once it grows beyond max_size bytes.
+    """
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+
+    def __contains__(self, key):
+        path = join(self.directory, key)
+        try:
+            # Mark as recently used
+            os.utime(path)
+        except OSError:
+            return False
+        return True
+
+    def add(self, key, scenario):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(join(self.directory, key), 'w') as file:
+                json.dump(dict(scenario=scenario, time=time.time()), file)
+            self._evict()
+        except OSError as e:
+            log.warning("Can't write result cache %s: %s", self.directory, e)
+
+    def _evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            stat = os.stat(join(self.directory, name))
+            entries.append((stat.st_mtime, stat.st_size, name))
+        size = sum(entry[1] for entry in entries)
+        for _, entry_size, name in sorted(entries):
+            if size <= self.max_size:
+                break
+            os.remove(join(self.directory, name))
+            size -= entry_size
+
+
+def split_scenario(scenario):
+    """Return (obj_cache, locators, events) of the unpickled scenario list"""
+    format_version = scenario[0]
+    obj_cache = scenario[1] if format_version > 0 else None
+    locators = scenario[2] if format_version > 1 else {}
+    return obj_cache, locators, scenario[1 + min(format_version, 2):]
+
+
 PathElement = namedtuple('PathElement', ('index', 'type', 'name'))
+# Locators of an object besides its PathElement path: its text (or
+# accessible name), and its geometry within its window, as
+# (window type, window name, x, y, width, height)
+ObjectLocators = namedtuple('ObjectLocators', ('text', 'geometry'))
 
 
 class Resolver:
@@ -286,10 +769,23 @@ class Resolver:
         def __getitem__(self, key):
             return key
 
-    def __init__(self, obj_cache):
+    def __init__(self, obj_cache, locators=None):
         self.id_obj_map = obj_cache if obj_cache is not None else self.IdentityMapper()
         self.obj_id_map = {}
         self.autoinc = count(1)
+        # obj_id -> ObjectLocators
+        self.locators = locators if locators is not None else {}
+        # str(obj_id) -> the locator strategy that found the object last time
+        self.strategy_stats = {}
+        self.strategy_stats_file = None
+        self.saved_strategy_stats = {}
+        self.strategy_wins = Counter()
+        # obj_id -> (weakref to the live widget resolved during replay,
+        #           its parent chain at the time)
+        self.id_widget_cache = {}
+        # Cached widget -> its obj_ids, uncached when the widget is destroyed
+        self.widget_ids = weakref.WeakKeyDictionary()
+        self.cache_hits = self.cache_misses = 0
 
     @staticmethod
     def _qenum_key(base, value, klass=None):
@@ -461,6 +957,12 @@ class Resolver:
         log.info('Serialized event: %s', event_str)
         return event_str
 
+    @staticmethod
+    def event_type_str(event_str):
+        """Return QEvent.Type name of serialized event, or '' if unknown"""
+        match = re.match(r'\w+\(QtCore\.QEvent\.(\w+)', event_str)
+        return match.group(1) if match else ''
+
     @staticmethod
     def deserialize_event(event_str):
         try:
@@ -541,6 +1043,27 @@ class Resolver:
             log.info('Serialized object path: %s', path)
         return path
 
+    @staticmethod
+    def _widget_text(widget):
+        """Return widget's accessible name, or its text, or ''"""
+        text = widget.accessibleName()
+        if not text and hasattr(widget, 'text'):
+            try:
+                text = widget.text()
+            except TypeError:  # Not a plain getter, e.g. QComboBox.itemText
+                pass
+        return text if isinstance(text, str) else ''
+
+    @classmethod
+    def serialize_locators(cls, obj):
+        window = obj.window()
+        pos = QtCore.QPoint(0, 0)
+        if obj is not window:
+            pos = obj.mapTo(window, pos)
+        return ObjectLocators(cls._widget_text(obj),
+                              (cls.serialize_type(type(window)), window.objectName(),
+                               pos.x(), pos.y(), obj.width(), obj.height()))
+
     @classmethod
     def _find_by_name(cls, target):
         return (qApp.findChild(cls.deserialize_type(target.type), target.name) or
@@ -548,30 +1071,170 @@ class Resolver:
                      if widget.objectName() == target.name))
 
     @classmethod
-    def deserialize_object(cls, path):
-        target = path[-1]
-
-        # Find target object by name
-        if target.name:
-            try:
-                return cls._find_by_name(target)
-            except StopIteration:
-                log.warning('Name "%s" provided, but no *widget* with that name '
-                            'found. If the test passes, its result might be '
-                            'invalid, or the test may just need updating.',
-                            target.name)
-
-        # If target widget doesn't have a name, find it in the tree
-        def get_child(i, widgets):
-            element = path[i]
+    def _walk_path(cls, elements, widgets):
+        """Return the widget at the end of path elements, starting with
+        (the children) widgets, or None"""
+        widget = None
+        for element in elements:
             widget = typed_nth(element.index,
                                cls.deserialize_type(element.type),
                                widgets)
-            if element == target or widget is None:
-                return widget
-            return get_child(i + 1, cls._get_children(widget))
+            if widget is None:
+                return None
+            widgets = cls._get_children(widget)
+        return widget
+
+    # Locator strategies, cheapest first
+    LOCATOR_STRATEGIES = ('name', 'text', 'geometry', 'path')
+
+    def _locate_by_name(self, obj_id, path):
+        """Find the deepest named object in path by name, then walk the rest"""
+        i = next((i for i in reversed(range(len(path))) if path[i].name), None)
+        if i is None:
+            return None
+        try:
+            widget = self._find_by_name(path[i])
+        except StopIteration:
+            log.warning('Name "%s" provided, but no *widget* with that name '
+                        'found. If the test passes, its result might be '
+                        'invalid, or the test may just need updating.',
+                        path[i].name)
+            return None
+        if i == len(path) - 1:
+            return widget
+        return self._walk_path(path[i + 1:], self._get_children(widget))
+
+    def _locate_by_text(self, obj_id, path):
+        """Find the single visible widget of the type with the same text"""
+        locator = self.locators.get(obj_id)
+        if not locator or not locator.text:
+            return None
+        widgets = [widget for widget in qApp.allWidgets()
+                   if self.serialize_type(type(widget)) == path[-1].type and
+                   widget.isVisible() and
+                   self._widget_text(widget) == locator.text]
+        return widgets[0] if len(widgets) == 1 else None
+
+    def _locate_by_geometry(self, obj_id, path):
+        """Find the widget of the type and size at the same place in its window"""
+        locator = self.locators.get(obj_id)
+        if not locator:
+            return None
+        window_type, window_name, x, y, width, height = locator.geometry
+        for window in qApp.topLevelWidgets():
+            if not (window.isVisible() and
+                    window.objectName() == window_name and
+                    self.serialize_type(type(window)) == window_type):
+                continue
+            widget = window.childAt(x + width // 2, y + height // 2) or window
+            while widget is not None:
+                if (self.serialize_type(type(widget)) == path[-1].type and
+                        widget.width() == width and
+                        widget.height() == height):
+                    return widget
+                widget = widget.parentWidget()
+        return None
+
+    def _locate_by_path(self, obj_id, path):
+        """Find the object by its typed index path from the top-level widgets"""
+        return self._walk_path(path, qApp.topLevelWidgets())
+
+    def deserialize_object(self, obj_id):
+        """
+        Return the widget of obj_id, trying the locator strategies cheapest
+        first, except the one that found it the last time, which goes first.
+        """
+        path = self.id_obj_map[obj_id]
+        last_strategy = self.strategy_stats.get(str(obj_id))
+        for strategy in sorted(self.LOCATOR_STRATEGIES,
+                               key=lambda strategy: strategy != last_strategy):
+            obj = getattr(self, '_locate_by_' + strategy)(obj_id, path)
+            if obj is not None:
+                log.debug('Object %s found by %s', path, strategy)
+                self.strategy_stats[str(obj_id)] = strategy
+                self.strategy_wins[strategy] += 1
+                return obj
+        return None
+
+    def load_strategy_stats(self, filename):
+        """Load which locator strategies found which objects the last time"""
+        self.strategy_stats_file = filename
+        try:
+            with open(filename) as file:
+                self.strategy_stats = json.load(file)
+        except (OSError, ValueError):
+            self.strategy_stats = {}
+        self.saved_strategy_stats = dict(self.strategy_stats)
+
+    def save_strategy_stats(self):
+        """Save the locator strategy stats, if changed; to be called only
+        after a successful replay"""
+        if (not self.strategy_stats_file or not self.strategy_stats or
+                self.strategy_stats == self.saved_strategy_stats):
+            return
+        try:
+            with open(self.strategy_stats_file, 'w') as file:
+                json.dump(self.strategy_stats, file, indent=1, sort_keys=True)
+        except OSError as e:
+            log.warning("Can't write locator stats %s: %s",
+                        self.strategy_stats_file, e)
 
-        return get_child(0, qApp.topLevelWidgets())
+    @classmethod
+    def _parent_chain(cls, widget):
+        """Return (name, type) of widget and its parents, innermost first"""
+        chain = []
+        while widget is not None:
+            chain.append((widget.objectName(), cls.serialize_type(type(widget))))
+            widget = widget.parentWidget()
+        return tuple(chain)
+
+    def _uncache_object(self, obj_id):
+        self.id_widget_cache.pop(obj_id, None)
+
+    def _uncache_objects(self, obj_ids, *_):
+        for obj_id in obj_ids:
+            self._uncache_object(obj_id)
+
+    def resolve_object(self, obj_id):
+        """Return the live widget for obj_id, locating it on cache miss"""
+        ref, chain = self.id_widget_cache.get(obj_id, (None, None))
+        obj = ref and ref()
+        # Valid while visible and parented as when it was located, which
+        # needn't be the recorded path if a locator strategy other than
+        # 'path' found it
+        if (obj is not None and obj.isVisible() and
+                self._parent_chain(obj) == chain):
+            self.cache_hits += 1
+            return obj
+        self.cache_misses += 1
+        self._uncache_object(obj_id)
+        obj = self.deserialize_object(obj_id)
+        if obj is not None:
+            self.id_widget_cache[obj_id] = (weakref.ref(obj),
+                                            self._parent_chain(obj))
+            obj_ids = self.widget_ids.get(obj)
+            if obj_ids is None:
+                # Connect once per widget, not on every cache miss
+                obj_ids = self.widget_ids[obj] = set()
+                obj.destroyed.connect(partial(self._uncache_objects, obj_ids))
+            obj_ids.add(obj_id)
+        return obj
+
+    def report_cache_stats(self):
+        total = self.cache_hits + self.cache_misses
+        if total:
+            log.info('Resolved-widget cache: %d hits, %d misses (%.1f%% hit rate)',
+                     self.cache_hits, self.cache_misses,
+                     100 * self.cache_hits / total)
+        if self.strategy_wins:
+            log.info('Objects found by locator strategy: %s',
+                     dict(self.strategy_wins))
+
+    def forget(self, obj_id):
+        """Remove obj_id, no longer referenced by any event, from the cache"""
+        obj_path = self.id_obj_map.pop(obj_id)
+        del self.obj_id_map[obj_path]
+        self.locators.pop(obj_id, None)
 
     def getstate(self, obj, event):
         """Return picklable state of the object and its event"""
@@ -588,18 +1251,22 @@ class Resolver:
             obj_id = next(self.autoinc)
             self.obj_id_map[obj_path] = obj_id
             self.id_obj_map[obj_id] = obj_path
+            self.locators[obj_id] = self.serialize_locators(obj)
         return (obj_id, event_str)
 
-    def setstate(self, obj_id, event_str):
+    def setstate(self, obj_id, event_str, post=False):
+        """Send the event to the object; if post, only post it to the queue"""
         obj_path = self.id_obj_map[obj_id]
-        obj = self.deserialize_object(obj_path)
+        obj = self.resolve_object(obj_id)
         if obj is None:
             log.error("Can't replay event %s on object %s: Object not found",
                       event_str, obj_path)
-            REAL_EXIT(3)
+            _terminate(3)
         event = self.deserialize_event(event_str)
         log.info('Replaying event %s on object %s',
                  event_str, obj_path)
+        if post:
+            return qApp.postEvent(obj, event)
         return qApp.sendEvent(obj, event)
 
     def print_state(self, i, obj_id, event_str):
@@ -611,24 +1278,27 @@ class Resolver:
                   el.index,
                   repr(el.name) if el.name else '',
                   el.type)
+        locator = self.locators.get(obj_id)
+        if locator:
+            if locator.text:
+                print('Text:', repr(locator.text))
+            print('Geometry in window: x={2} y={3} w={4} h={5}'.format(*locator.geometry))
         print()
 
 
 class _EventFilter:
     @staticmethod
     def wait_for_app_start(method):
-        is_started = False
-
         def wrapper(self, obj, event):
-            nonlocal is_started
+            # Per instance, as the app may be run many times in one process
+            is_started = getattr(self, '_is_started', False)
             if not is_started:
-                log.debug('Caught %s (%s) event but app not yet fully "started"',
-                          EVENT_TYPE.get(event.type(),
-                                         'QEvent(type=' + str(event.type()) + ')'),
-                          type(event).__name__)
+                if log.isEnabledFor(logging.DEBUG):
+                    log.debug('Caught %s (%s) event but app not yet fully "started"',
+                              event_type_name(event), type(event).__name__)
                 if event.type() == QtCore.QEvent.ActivationChange:
                     log.debug("Ok, app is started now, don't worry")
-                    is_started = True
+                    is_started = self._is_started = True
             # With the following return in place, Xvfb sometimes got stuck
             # before any serious events happened. I suspected WM (or lack
             # thereof) being the culprit, so now we spawn a WM that sends
@@ -638,22 +1308,36 @@ class _EventFilter:
             return method(self, obj, event) if is_started else False
         return wrapper
 
+    def dump(self):
+        """Save what can be saved before the app crashes"""
+        pass
+
     def close(self):
         pass
 
 
 class EventRecorder(_EventFilter):
-    def __init__(self, file, events_include, events_exclude):
+    def __init__(self, file, events_include, events_exclude,
+                 flight_events=None, flight_minutes=None):
         super().__init__()
         self.file = file
 
         # Prepare the recorded events stack;
         # the first entry is the protocol version
         self.events = [SCENARIO_FORMAT_VERSION]
-        obj_cache = {}
-        self.events.append(obj_cache)
+        obj_cache, locators = {}, {}
+        self.events.extend((obj_cache, locators))
 
-        self.resolver = Resolver(obj_cache)
+        self.resolver = Resolver(obj_cache, locators)
+
+        # In flight-recorder mode, the recorded events are kept in a ring
+        # buffer of (time, event) instead, and obj_cache entries are
+        # reference-counted so they are evicted along with their last event
+        self.ring = None
+        if flight_events or flight_minutes:
+            self.ring = deque(maxlen=flight_events)
+            self.max_age = flight_minutes and flight_minutes * 60
+            self.obj_refcount = Counter()
 
         is_included = (re.compile('|'.join(events_include.split(','))).search
                        if events_include else lambda _: True)
@@ -672,13 +1356,12 @@ class EventRecorder(_EventFilter):
         #     return False
         is_skipped = (not self.event_matches(type(event).__name__) or
                       not isinstance(obj, QWidget))  # FIXME: This condition is too strict (QGraphicsItems are QOjects)
-        log_ = log.debug if is_skipped else log.info
-        log_('Caught %s%s %s event (%s) on object %s',
-             'skipped' if is_skipped else 'recorded',
-             ' spontaneous' if event.spontaneous() else '',
-             EVENT_TYPE.get(event.type(),
-                            'Unknown(type=' + str(event.type()) + ')'),
-             event.__class__.__name__, obj)
+        level = logging.DEBUG if is_skipped else logging.INFO
+        if log.isEnabledFor(level):
+            log.log(level, 'Caught %s%s %s event (%s) on object %s',
+                    'skipped' if is_skipped else 'recorded',
+                    ' spontaneous' if event.spontaneous() else '',
+                    event_type_name(event), event.__class__.__name__, obj)
         # Before any event on any widget, make sure the window of that widget
         # is active and raised (in front). This is required for replaying
         # without a window manager.
@@ -691,61 +1374,190 @@ class EventRecorder(_EventFilter):
         if not is_skipped:
             serialized = self.resolver.getstate(obj, event)
             if serialized:
-                self.events.append(serialized)
+                if self.ring is None:
+                    self.events.append(serialized)
+                else:
+                    self._record_flight(serialized)
         return False
 
+    def _record_flight(self, serialized):
+        now = time.monotonic()
+        # Reference the object before evicting, lest it's evicted itself
+        self.obj_refcount[serialized[0]] += 1
+        if len(self.ring) == self.ring.maxlen:
+            self._evict_flight()
+        self.ring.append((now, serialized))
+        self._evict_old_flights(now)
+
+    def _evict_old_flights(self, now):
+        if self.max_age:
+            while self.ring and self.ring[0][0] < now - self.max_age:
+                self._evict_flight()
+
+    def _evict_flight(self):
+        _, (obj_id, _) = self.ring.popleft()
+        self.obj_refcount[obj_id] -= 1
+        if not self.obj_refcount[obj_id]:
+            del self.obj_refcount[obj_id]
+            self.resolver.forget(obj_id)
+
+    def scenario(self):
+        """Return the recorded scenario as it is to be pickled"""
+        if self.ring is None:
+            return self.events
+        # Events age also while none are recorded
+        self._evict_old_flights(time.monotonic())
+        return self.events[:3] + [event for _, event in self.ring]
+
+    def _write(self):
+        """(Re)write the scenario file with the scenario recorded so far"""
+        scenario = self.scenario()
+        self.file.seek(0)
+        self.file.truncate()
+        pickle.dump(scenario, self.file, protocol=0)
+        self.file.flush()
+        return scenario
+
+    def dump(self):
+        scenario = self._write()
+        log.warning("Scenario of the last %d events written into '%s'",
+                    len(split_scenario(scenario)[2]), self.file.name)
+
     def close(self):
         """Write out the scenario"""
         log.debug('Writing scenario file')
-        pickle.dump(self.events, self.file, protocol=0)
+        scenario = self._write()
         log.info("Scenario of %d events written into '%s'",
-                 len(self.events) - SCENARIO_FORMAT_VERSION - 1, self.file.name)
-        log.debug(self.events)
+                 len(split_scenario(scenario)[2]), self.file.name)
+        log.debug(scenario)
 
 
 class EventReplayer(_EventFilter):
-    def __init__(self, file):
+    def __init__(self, file, batch_policy=None, soak=None, watchdog=None):
         super().__init__()
+        self.watchdog = watchdog
+        # The event(s) being replayed, for stall reports
+        self.current_batch = None
+        # QEvent type name -> max number of such events replayed in a batch
+        self.batch_policy = batch_policy or {}
         # Replay events X ms after the last event
         self.timer = QtCore.QTimer(self, interval=50)
         self.timer.timeout.connect(self.replay_next_event)
-        self.load(file)
+        # Dispatch time of each replayed event, in seconds
+        self.latencies = []
+        # Scenario name -> (Resolver, events)
+        self.scenarios = {file.name: self.load(file)
+                          for file in (soak.files if soak else [file])}
+        # The names of scenarios to replay in turn
+        self.plan = (soak.plan(self.latencies,
+                               lambda: len(qApp.allWidgets()),
+                               QtCore.QObject)
+                     if soak else iter([file.name]))
+        self.soak = soak
+        self.resolver = None
+        self.events = iter(())
+        self._lookahead = None
 
-    def load(self, file):
-        self._events = pickle.load(file)
-        self.events = iter(self._events)
-        format_version = next(self.events)
-        obj_cache = next(self.events) if format_version > 0 else None
-        self.resolver = Resolver(obj_cache)
+    @staticmethod
+    def load(file):
+        obj_cache, locators, events = split_scenario(pickle.load(file))
+        resolver = Resolver(obj_cache, locators)
+        resolver.load_strategy_stats(file.name + '.locators')
+        return resolver, events
+
+    def _start_next_scenario(self):
+        name = next(self.plan, None)
+        if name is None:
+            return False
+        log.info('Replaying scenario %s', name)
+        self.resolver, events = self.scenarios[name]
+        self.events = iter(events)
+        return True
 
     @_EventFilter.wait_for_app_start
     def eventFilter(self, _, event):
+        if self.watchdog:
+            self.watchdog.beat()
         if (event.type() == QtCore.QEvent.Timer and
                 event.timerId() == self.timer.timerId()):
             # Skip self's timer events
             return False
-        log.debug('Caught %s (%s) event; resetting timer',
-                  EVENT_TYPE.get(event.type(), 'Unknown(type=' + str(event.type()) + ')'),
-                  type(event))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('Caught %s (%s) event; resetting timer',
+                      event_type_name(event), type(event))
         self.timer.stop()
         self.timer.start()
         return False
 
     def replay_next_event(self):
-        # TODO: if timer took too long (significantly more than its interval)
-        # perhaps there was a busy loop in the code; better restart it
+        # If the timer takes too long (significantly more than its interval)
+        # there's a busy loop in the app; the watchdog reports it
         self.timer.stop()
-        event = next(self.events, None)
-        if not event:
+        batch = self._next_batch()
+        while not batch and self._start_next_scenario():
+            batch = self._next_batch()
+        if not batch:
             log.info('No more events to replay.')
+            if self.watchdog:
+                # No more beats come once the event loop ends, but the app's
+                # teardown mustn't be reported as a stall
+                self.watchdog.stop()
             QtGui.qApp.quit()
             return
-        log.debug('Replaying event: %s', event)
-        self.resolver.setstate(*event)
+        self.current_batch = batch
+        start = time.perf_counter()
+        if len(batch) == 1:
+            log.debug('Replaying event: %s', batch[0])
+            self.resolver.setstate(*batch[0])
+        else:
+            # Post all events at once and process them in a single pass.
+            # Posted events are delivered in order, so this is deterministic.
+            log.debug('Replaying batch of %d events: %s', len(batch), batch)
+            for event in batch:
+                self.resolver.setstate(*event, post=True)
+            qApp.sendPostedEvents()
+        self.latencies.extend(repeat((time.perf_counter() - start) / len(batch),
+                                     len(batch)))
         return False
 
+    def _next_batch(self):
+        """
+        Return the list of next events that don't require the app to settle
+        in between: a run of events of batched types on the same object.
+        """
+        event = self._lookahead or next(self.events, None)
+        self._lookahead = None
+        if not event:
+            return []
+        batch = [event]
+        obj_id = event[0]
+        max_size = self.batch_policy.get(self.resolver.event_type_str(event[1]))
+        if not max_size:
+            return batch
+        for event in self.events:
+            size = self.batch_policy.get(self.resolver.event_type_str(event[1]))
+            max_size = min(max_size, size or 0)
+            if event[0] != obj_id or len(batch) >= max_size:
+                # Keep it for the next time
+                self._lookahead = event
+                break
+            batch.append(event)
+        return batch
+
     def close(self):
-        remaining_events = list(self.events)
+        if self.watchdog:
+            self.watchdog.stop()
+            if self.watchdog.n_stalls:
+                log.warning('The app stalled %d times during replay',
+                            self.watchdog.n_stalls)
+        for resolver, _ in self.scenarios.values():
+            resolver.report_cache_stats()
+        if self.soak:
+            # Stop tracing memory allocations if the soak ended early
+            self.plan.close()
+            self.soak.report()
+        self.remaining_events = remaining_events = (
+            [self._lookahead] if self._lookahead else []) + list(self.events)
         if remaining_events:
             log.warning("Application didn't manage to replay all events. "
                         "This may indicate failure. But not necessarily. :|")
@@ -754,11 +1566,9 @@ class EventReplayer(_EventFilter):
 
 class EventExplainer:
     def __init__(self, file):
-        self._events = pickle.load(file)
-        self.events = iter(self._events)
-        format_version = next(self.events)
-        obj_cache = next(self.events) if format_version > 0 else None
-        self.resolver = Resolver(obj_cache)
+        obj_cache, locators, events = split_scenario(pickle.load(file))
+        self.events = iter(events)
+        self.resolver = Resolver(obj_cache, locators)
 
     def run(self):
         for i, event in enumerate(self.events):
@@ -782,29 +1592,88 @@ def EventFilter(klass, *args):
     return EventFilter(*args)
 
 
-def main():
-    args = parse_args()
+ReplayResult = namedtuple('ReplayResult',
+                          ('scenario', 'latencies', 'wall_time', 'cpu_time'))
+
+
+def run(args):
+    """Run the sub-command of parsed args; return exit status"""
+    from . import timings
+    from .watchdog import Watchdog
 
     if args._subcommand == 'explain':
         explainer = EventExplainer(args.scenario)
         explainer.run()
         return 0
+    if args._subcommand == 'compare':
+        return timings.compare(args)
+    if args._subcommand == 'coordinate':
+        from .distributed import coordinate
+        return coordinate(args)
+    if args._subcommand == 'work':
+        from .distributed import work
+        return work(args)
 
     event_filters = []
+    real_sigusr1 = None
     if args._subcommand == 'record':
         recorder = EventFilter(EventRecorder,
                                args.scenario,
                                args.events_include,
-                               args.events_exclude)
+                               args.events_exclude,
+                               args.flight_events,
+                               args.flight_minutes)
         event_filters.append(recorder)
+        if recorder.ring is not None:
+            real_sigusr1 = signal.signal(signal.SIGUSR1,
+                                         lambda *_: recorder.dump())
+    is_stalled = False
     if args._subcommand == 'replay':
-        replayer = EventFilter(EventReplayer, args.scenario)
+        watchdog = None
+        if args.stall_threshold:
+            def on_stall_timeout():
+                nonlocal is_stalled
+                if _library_mode:
+                    # Don't kill the host process (e.g. a pytest worker);
+                    # the KeyboardInterrupt is turned into EXIT_STALL below
+                    is_stalled = True
+                    _thread.interrupt_main()
+                    return
+                stop_logging()
+                os._exit(EXIT_STALL)
+
+            watchdog = Watchdog(args.stall_threshold,
+                                1 / args.stall_sample_rate,
+                                args.stall_timeout,
+                                lambda: replayer.current_batch,
+                                on_stall_timeout)
+        replayer = EventFilter(EventReplayer, args.scenario, args.batch,
+                               args.soak, watchdog)
         event_filters.append(replayer)
+        if watchdog:
+            watchdog.start()
 
     assert event_filters
 
+    def install_event_filters(app):
+        for event_filter in event_filters:
+            log.debug('Installing event filter: %s',
+                      type(event_filter).mro()[1].__name__)
+            app.installEventFilter(event_filter)
+
     # Patch QApplication to filter all events through EventRecorder / EventReplayer
-    class QApplication(QtGui.QApplication):
+    RealQApplication = QtGui.QApplication
+
+    class QApplication(RealQApplication):
+        def __new__(cls, *args, **kwargs):
+            # Qt allows a single QApplication per process. When used as a
+            # library, the app may be run many times; reuse the instance.
+            app = RealQApplication.instance()
+            if app is not None:
+                install_event_filters(app)
+                return app
+            return super().__new__(cls, *args, **kwargs)
+
         def __init__(self, *args, **kwargs):
             # Before constructing the application, prevent the application of
             # any custom, desktop environment-dependent styles and settings.
@@ -812,10 +1681,7 @@ def main():
             # the same.
             QApplication.setDesktopSettingsAware(False)
             super().__init__(*args, **kwargs)
-            for event_filter in event_filters:
-                log.debug('Installing event filter: %s',
-                          type(event_filter).mro()[1].__name__)
-                self.installEventFilter(event_filter)
+            install_event_filters(self)
     QtGui.QApplication = QApplication
 
     # Prevent exit with zero status from inside the app. We need to exit from this app.
@@ -823,27 +1689,131 @@ def main():
         log.warning('Prevented call to sys.exit() with status: %s', str(status))
         if status != 0:
             log.warning('But the exit status was non-zero, so quitting')
-            REAL_EXIT(status)
-    sys.exit = logging_exit
+            _terminate(status)
+    real_exit, sys.exit = sys.exit, logging_exit
 
     # Qt doesn't raise exceptions out of its event loop; but this works
+    failure_status = 0
+
     def excepthook(etype, value, tback):
-        import traceback
-        log.error('Unhandled exception encountered')
-        traceback.print_exception(etype, value, tback)
-        REAL_EXIT(2)
-    sys.excepthook = excepthook
-
-    # Allow termination with Ctrl+C
-    signal.signal(signal.SIGINT, signal.SIG_DFL)
+        nonlocal failure_status
+        if isinstance(value, PyQtTesterError):
+            # _terminate() called from within the Qt event loop
+            failure_status = value.status
+        elif is_stalled and isinstance(value, KeyboardInterrupt):
+            failure_status = EXIT_STALL
+        else:
+            import traceback
+            log.error('Unhandled exception encountered')
+            traceback.print_exception(etype, value, tback)
+            for event_filter in event_filters:
+                event_filter.dump()
+            failure_status = 2
+        if not _library_mode:
+            REAL_EXIT(failure_status)
+        qApp.exit(failure_status)
+    real_excepthook, sys.excepthook = sys.excepthook, excepthook
+
+    if not _library_mode:
+        # Allow termination with Ctrl+C
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
     # Execute the app
-    args.main()
-
+    real_argv = sys.argv
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+    try:
+        args.main()
+    except PyQtTesterError as e:
+        failure_status = e.status
+    except KeyboardInterrupt:
+        if not is_stalled:
+            raise
+        failure_status = EXIT_STALL
+    finally:
+        wall_time = time.perf_counter() - start_wall
+        cpu_time = time.process_time() - start_cpu
+        QtGui.QApplication = RealQApplication
+        sys.exit, sys.excepthook, sys.argv = real_exit, real_excepthook, real_argv
+        if real_sigusr1 is not None:
+            signal.signal(signal.SIGUSR1, real_sigusr1)
+        app = RealQApplication.instance()
+        for event_filter in event_filters:
+            if app is not None:
+                app.removeEventFilter(event_filter)
+            event_filter.close()
+
+    if failure_status:
+        return failure_status
     log.info('Application exited successfully. Congrats!')
 
-    for event_filter in event_filters:
-        event_filter.close()
+    if args._subcommand == 'replay':
+        args.result = ReplayResult(args.scenario.name, replayer.latencies,
+                                   wall_time, cpu_time)
+        if not replayer.remaining_events:
+            # Only strategies that led to a successful replay go first next time
+            for resolver, _ in replayer.scenarios.values():
+                resolver.save_strategy_stats()
+            if args.result_key:
+                args.result_cache.add(args.result_key, args.scenario.name)
+        # Soak runs' wall times and (traced) latencies aren't comparable
+        if args.timings and not args.soak:
+            timings.record(args.timings, args.scenario.name, args.qt,
+                           QtCore.PYQT_VERSION_STR, wall_time, cpu_time,
+                           replayer.latencies,
+                           is_own_process=not _library_mode)
     return 0
 
+
+def _run_library(argv):
+    global _library_mode
+    _library_mode = True
+    args = None
+    try:
+        args = parse_args(argv)
+        status = run(args)
+    except PyQtTesterError as e:
+        status = e.status
+    except SystemExit:
+        # E.g. invalid arguments or --help
+        status = 1
+    finally:
+        _library_mode = False
+        # Unlike the process, the opened scenario files live on
+        if args is not None:
+            _close_files(args)
+    if status:
+        raise PyQtTesterError(status)
+    return args
+
+
+def record(scenario, main, *options, app_args=(), qt='5'):
+    """
+    Record the scenario of the app's entry point main ('module.path.to:main
+    function') into the scenario file, without exiting the process.
+
+    options are additional `record` command-line options. Raise
+    PyQtTesterError on failure.
+    """
+    _run_library(['record', '--qt', str(qt)] + list(options) +
+                 [scenario, main] + list(app_args))
+
+
+def replay(scenario, main, *options, app_args=(), qt='5'):
+    """
+    Replay the scenario file against the app's entry point main
+    ('module.path.to:main function'), without exiting the process.
+
+    options are additional `replay` command-line options, e.g.
+    ('--no-cache', '--batch', ''); --x11 and --x11-video aren't supported.
+    Return ReplayResult, or None if the replay was skipped (result cache).
+    Raise PyQtTesterError on failure.
+    """
+    args = _run_library(['replay', '--qt', str(qt)] + list(options) +
+                        [scenario, main] + list(app_args))
+    return getattr(args, 'result', None)
+
+
+def main():
+    return run(parse_args())
+
 if __name__ == '__main__':
     REAL_EXIT(main())
@@ -0,0 +1,330 @@
+"""
+Distributed scenario execution.
+
+A coordinator serves a queue of (scenario, Qt version, replay arguments)
+jobs over a TCP socket. Workers, on any host that has the app installed,
+pull jobs, run `replay` locally, and send back the exit code, the log,
+and any artifacts (e.g. video) the replay produced. Jobs of workers that
+stop sending heartbeats are handed out again.
+
+The protocol is one JSON line request, one JSON line response per
+connection.
+"""
+
+import os
+import json
+import time
+import shlex
+import socket
+import logging
+import tempfile
+import threading
+import subprocess
+import socketserver
+from os.path import basename, join
+from base64 import b64encode, b64decode
+from collections import deque, defaultdict, Counter
+from itertools import product
+
+log = logging.getLogger(__name__)
+
+SOCKET_TIMEOUT = 60
+# A worker that fails to run this many jobs in a row exits
+MAX_WORKER_FAILURES = 5
+
+
+def parse_address(address):
+    """Return (host, port) tuple from 'HOST:PORT' string"""
+    host, _, port = address.rpartition(':')
+    return host or 'localhost', int(port)
+
+
+def request(address, message):
+    """Send message to the coordinator at address and return its response"""
+    with socket.create_connection(address, timeout=SOCKET_TIMEOUT) as sock:
+        sock.sendall(json.dumps(message).encode() + b'\n')
+        with sock.makefile('rb') as file:
+            response = json.loads(file.readline().decode())
+    if not isinstance(response, dict):
+        raise ValueError('response must be a JSON object')
+    return response
+
+
+def make_jobs(scenarios, main, app_args, qt_versions, replay_args):
+    """Return the list of jobs of the full (scenario, Qt, args) matrix"""
+    jobs = []
+    for (name, data), qt, extra_args in product(scenarios,
+                                                qt_versions,
+                                                replay_args or ['']):
+        jobs.append(dict(id=len(jobs) + 1,
+                         scenario_name=basename(name),
+                         scenario=b64encode(data).decode(),
+                         qt=qt,
+                         main=main,
+                         args=app_args,
+                         replay_args=shlex.split(extra_args)))
+    return jobs
+
+
+class Coordinator:
+    def __init__(self, jobs, lease_timeout, retries):
+        self.jobs = {job['id']: job for job in jobs}
+        self.lease_timeout = lease_timeout
+        self.retries = retries
+        self.pending = deque(jobs)
+        self.leased = {}  # job id -> lease deadline
+        self.lessees = {}  # job id -> worker
+        self.failed_workers = defaultdict(set)  # job id -> workers
+        self.attempts = Counter()
+        self.results = {}
+        self.cond = threading.Condition()
+
+    @property
+    def is_done(self):
+        return len(self.results) == len(self.jobs)
+
+    def _fail(self, job_id, reason):
+        """Retry the job, or give up on it if it was tried too many times"""
+        self.leased.pop(job_id, None)
+        self.failed_workers[job_id].add(self.lessees.pop(job_id, None))
+        if self.attempts[job_id] <= self.retries:
+            log.warning('Job %d failed (%s); retrying', job_id, reason)
+            # Others' jobs go first, giving other workers a chance to retry it
+            self.pending.append(self.jobs[job_id])
+        else:
+            log.error('Job %d failed (%s) %d times; giving up',
+                      job_id, reason, self.attempts[job_id])
+            self.results[job_id] = dict(exit_code=None, error=reason,
+                                        log='', artifacts={})
+            self.cond.notify_all()
+
+    def requeue_expired(self):
+        now = time.monotonic()
+        for job_id, deadline in list(self.leased.items()):
+            if deadline < now:
+                self._fail(job_id, 'worker lease expired')
+
+    def handle(self, message):
+        op = message.get('op')
+        with self.cond:
+            self.requeue_expired()
+            if op == 'get':
+                worker = message.get('worker')
+                # Prefer jobs that didn't already fail on this worker
+                jobs = [job for job in self.pending if job['id'] not in self.results]
+                job = next((job for job in jobs
+                            if worker not in self.failed_workers[job['id']]),
+                           jobs[0] if jobs else None)
+                self.pending = deque(other for other in jobs if other is not job)
+                if job is None:
+                    if self.is_done:
+                        return dict(op='done')
+                    return dict(op='wait', seconds=1)
+                self.attempts[job['id']] += 1
+                self.leased[job['id']] = time.monotonic() + self.lease_timeout
+                self.lessees[job['id']] = worker
+                log.info('Job %d (%s, Qt%s) -> worker %s',
+                         job['id'], job['scenario_name'], job['qt'],
+                         message.get('worker'))
+                return dict(op='job', job=job, heartbeat=self.lease_timeout / 3)
+
+            job_id = message.get('id')
+            if job_id not in self.jobs:
+                return dict(op='error', error='unknown job')
+            if op == 'heartbeat':
+                if job_id not in self.leased:
+                    return dict(op='cancel')
+                self.leased[job_id] = time.monotonic() + self.lease_timeout
+                return dict(op='ok')
+            if op == 'error':
+                if job_id in self.leased:
+                    self._fail(job_id, message.get('error'))
+                return dict(op='ok')
+            if op == 'result':
+                if not {'exit_code', 'log', 'artifacts'} <= message.keys():
+                    return dict(op='error', error='incomplete result')
+                self.leased.pop(job_id, None)
+                self.lessees.pop(job_id, None)
+                if job_id not in self.results:
+                    log.info('Job %d finished with exit code %s on worker %s',
+                             job_id, message['exit_code'], message.get('worker'))
+                    self.results[job_id] = message
+                    self.cond.notify_all()
+                return dict(op='ok')
+        return dict(op='error', error='unknown op')
+
+    def wait(self):
+        with self.cond:
+            while not self.is_done:
+                self.cond.wait(1)
+                self.requeue_expired()
+
+    def save_results(self, results_dir):
+        """Write logs and artifacts of all jobs into results_dir"""
+        for job_id, result in sorted(self.results.items()):
+            job = self.jobs[job_id]
+            job_dir = join(results_dir, '{:03d}-{}-qt{}'.format(
+                job_id, job['scenario_name'], job['qt']))
+            os.makedirs(job_dir, exist_ok=True)
+            with open(join(job_dir, 'log.txt'), 'w', encoding='utf-8') as file:
+                file.write(result['log'])
+            for name, data in result['artifacts'].items():
+                with open(join(job_dir, basename(name)), 'wb') as file:
+                    file.write(b64decode(data))
+
+    def print_summary(self):
+        for job_id, result in sorted(self.results.items()):
+            job = self.jobs[job_id]
+            print('{:>4} {:<6} Qt{} {} {}'.format(
+                job_id,
+                'OK' if result['exit_code'] == 0 else 'FAIL',
+                job['qt'],
+                job['scenario_name'],
+                ' '.join(job['replay_args'])))
+
+
+def coordinate(args):
+    """Serve the jobs to workers until all are done; return exit status"""
+    coordinator = Coordinator(make_jobs(args.scenarios, args.main, args.args,
+                                        args.qt, args.replay_args),
+                              args.lease_timeout, args.retries)
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            try:
+                message = json.loads(self.rfile.readline().decode())
+                if not isinstance(message, dict):
+                    raise ValueError('message must be a JSON object')
+                response = coordinator.handle(message)
+            except (ValueError, TypeError, KeyError) as e:
+                response = dict(op='error', error=str(e))
+            self.wfile.write(json.dumps(response).encode() + b'\n')
+
+    class Server(socketserver.ThreadingTCPServer):
+        allow_reuse_address = True
+        daemon_threads = True
+
+    server = Server(parse_address(args.bind), Handler)
+    log.warning('Coordinator serving %d jobs on %s:%d',
+                len(coordinator.jobs), *server.server_address[:2])
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        coordinator.wait()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    coordinator.save_results(args.results_dir)
+    coordinator.print_summary()
+    return int(any(result['exit_code'] != 0
+                   for result in coordinator.results.values()))
+
+
+def run_job(job, command, verbose, heartbeat):
+    """Replay the job's scenario locally; heartbeat() is called periodically
+    and the replay is killed (and None returned) if it returns False"""
+    with tempfile.TemporaryDirectory(prefix='pyqttester-') as tmpdir:
+        scenario = join(tmpdir, job['scenario_name'])
+        with open(scenario, 'wb') as file:
+            file.write(b64decode(job['scenario']))
+        log_file = join(tmpdir, 'pyqttester-worker.log')
+        argv = (shlex.split(command) + ['-v'] * verbose +
+                # Cache hits would pass without a log, artifacts or timings
+                ['replay', '--no-cache', '--qt', job['qt']] + job['replay_args'] +
+                [scenario, job['main']] + job['args'])
+        log.info('Running: %s', argv)
+        with open(log_file, 'wb') as output:
+            process = subprocess.Popen(argv, cwd=tmpdir,
+                                       stdout=output, stderr=subprocess.STDOUT)
+            while True:
+                try:
+                    exit_code = process.wait(timeout=heartbeat.interval)
+                    break
+                except subprocess.TimeoutExpired:
+                    if not heartbeat():
+                        log.warning('Job %d cancelled by coordinator', job['id'])
+                        process.kill()
+                        process.wait()
+                        return None
+        with open(log_file, encoding='utf-8', errors='replace') as file:
+            job_log = file.read()
+        artifacts = {}
+        for name in os.listdir(tmpdir):
+            path = join(tmpdir, name)
+            if path not in (scenario, log_file) and os.path.isfile(path):
+                with open(path, 'rb') as file:
+                    artifacts[name] = b64encode(file.read()).decode()
+        return dict(exit_code=exit_code, log=job_log, artifacts=artifacts)
+
+
+def work(args):
+    """Pull and run jobs from the coordinator until it has none left"""
+    address = parse_address(args.coordinator)
+    worker = '{}:{}'.format(socket.gethostname(), os.getpid())
+    connect_deadline = time.monotonic() + args.connect_timeout
+    is_connected = False
+    n_failures = 0
+    while True:
+        try:
+            response = request(address, dict(op='get', worker=worker))
+        except ValueError as e:
+            log.warning('Invalid response from coordinator: %s', e)
+            time.sleep(1)
+            continue
+        except OSError as e:
+            if is_connected:
+                log.info('Coordinator gone (%s); exiting', e)
+                return 0
+            if time.monotonic() > connect_deadline:
+                log.error("Can't connect to coordinator %s: %s", args.coordinator, e)
+                return 1
+            time.sleep(1)
+            continue
+        is_connected = True
+
+        if response['op'] == 'done':
+            log.info('No more jobs')
+            return 0
+        if response['op'] == 'wait':
+            time.sleep(response['seconds'])
+            continue
+        if response['op'] != 'job':
+            log.error('Unexpected response from coordinator: %s', response)
+            return 1
+
+        job = response['job']
+
+        def heartbeat():
+            """Return False if the coordinator cancelled the job"""
+            try:
+                response = request(address, dict(op='heartbeat', id=job['id'],
+                                                 worker=worker))
+            except (OSError, ValueError) as e:
+                log.warning('Heartbeat for job %d failed: %s', job['id'], e)
+                return True
+            return response.get('op') != 'cancel'
+
+        heartbeat.interval = response['heartbeat']
+        try:
+            result = run_job(job, args.command, args.verbose or 0, heartbeat)
+            if result is None:
+                continue
+            message = dict(result, op='result', id=job['id'], worker=worker)
+            n_failures = 0
+        except OSError as e:
+            log.error('Running job %d failed: %s', job['id'], e)
+            message = dict(op='error', id=job['id'], worker=worker, error=str(e))
+            n_failures += 1
+        try:
+            request(address, message)
+        except ValueError as e:
+            log.warning('Invalid response from coordinator: %s', e)
+        except OSError as e:
+            log.info('Coordinator gone (%s); exiting', e)
+            return 0
+        if n_failures >= MAX_WORKER_FAILURES:
+            log.error('Failed to run %d jobs in a row; exiting', n_failures)
+            return 1
+        if n_failures:
+            # Back off, letting other workers pick up the job
+            time.sleep(min(2 ** n_failures, SOCKET_TIMEOUT))
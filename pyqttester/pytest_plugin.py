@@ -0,0 +1,177 @@
+"""
+pytest plugin that collects *.scenario files as test items and replays
+them against the app entry point set with --pyqttester-main (or the
+pyqttester_main ini option). Without it, no scenarios are collected.
+
+All scenarios replayed in a pytest process (i.e. per pytest-xdist worker)
+share one imported app and, with --pyqttester-x11, one headless X11
+display.
+"""
+
+import os
+import shlex
+import subprocess
+from importlib import import_module
+
+import pytest
+
+from . import replay, PyQtTesterError
+from .timings import percentile
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup('pyqttester', 'PyQt GUI scenarios (PyQtTester)')
+    group.addoption(
+        '--pyqttester-main', metavar='MODULE_PATH',
+        help='The application entry point (module.path.to:main function) '
+             'to replay *.scenario files with.')
+    group.addoption(
+        '--pyqttester-qt', metavar='QT_VERSION', default=None,
+        help='The version of PyQt to replay scenarios with (4 or 5).')
+    group.addoption(
+        '--pyqttester-x11', action='store_true', default=None,
+        help='Replay scenarios in a headless X11 server (Xvfb), one per '
+             'pytest process.')
+    group.addoption(
+        '--pyqttester-options', metavar='OPTIONS', default=None,
+        help='Additional PyQtTester replay options, e.g. "--batch=".')
+    parser.addini('pyqttester_main', 'Default for --pyqttester-main.')
+    parser.addini('pyqttester_qt', 'Default for --pyqttester-qt.', default='5')
+    parser.addini('pyqttester_x11', 'Default for --pyqttester-x11.',
+                  type='bool', default=False)
+    parser.addini('pyqttester_options', 'Default for --pyqttester-options.',
+                  default='')
+
+
+def _option(config, name):
+    value = config.getoption('pyqttester_' + name)
+    return config.getini('pyqttester_' + name) if value is None else value
+
+
+class _Display:
+    """A headless X11 server (Xvfb) shared by all scenarios of the process"""
+    def __init__(self):
+        self.process = None
+        self.real_display = None
+
+    def start(self):
+        read_fd, write_fd = os.pipe()
+        try:
+            # Let Xvfb pick a free display number and tell us which
+            self.process = subprocess.Popen(
+                ['Xvfb', '-displayfd', str(write_fd), '-nolisten', 'tcp',
+                 '-screen', '0', '1280x1024x24'],
+                pass_fds=(write_fd,),
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        except OSError as e:
+            os.close(read_fd)
+            raise pytest.UsageError('--pyqttester-x11 requires Xvfb: {}'.format(e))
+        finally:
+            os.close(write_fd)
+        with os.fdopen(read_fd) as file:
+            display = file.readline().strip()
+        if not display:
+            raise pytest.UsageError('Xvfb failed to start')
+        self.real_display = os.environ.get('DISPLAY')
+        os.environ['DISPLAY'] = ':' + display
+
+    def stop(self):
+        if self.process is None:
+            return
+        self.process.terminate()
+        self.process.wait()
+        self.process = None
+        if self.real_display is None:
+            os.environ.pop('DISPLAY', None)
+        else:
+            os.environ['DISPLAY'] = self.real_display
+
+
+class _Session:
+    """Per-process state, set up lazily on the first replayed scenario"""
+    def __init__(self, config):
+        self.config = config
+        self.display = _Display()
+        self.is_set_up = False
+
+    def setup(self):
+        if self.is_set_up:
+            return
+        main = _option(self.config, 'main')
+        if not main:
+            raise pytest.UsageError(
+                'Replaying *.scenario files requires --pyqttester-main '
+                '(or pyqttester_main ini option)')
+        if _option(self.config, 'x11'):
+            self.display.start()
+        # Import the app once, outside of any test's duration
+        import_module(main.partition(':')[0])
+        self.is_set_up = True
+
+    def teardown(self):
+        self.display.stop()
+
+
+def pytest_configure(config):
+    config._pyqttester = _Session(config)
+
+
+def pytest_unconfigure(config):
+    session = getattr(config, '_pyqttester', None)
+    if session:
+        session.teardown()
+
+
+def pytest_collect_file(parent, file_path):
+    # The plugin is loaded wherever PyQtTester is installed; only collect
+    # scenarios in projects that configured the app to replay them with
+    if file_path.suffix == '.scenario' and _option(parent.config, 'main'):
+        return ScenarioFile.from_parent(parent, path=file_path)
+
+
+@pytest.fixture(scope='session')
+def pyqttester_display(pytestconfig):
+    """The shared headless X11 display (:N), or None if not used"""
+    session = pytestconfig._pyqttester
+    session.setup()
+    return os.environ['DISPLAY'] if session.display.process else None
+
+
+class ScenarioFile(pytest.File):
+    def collect(self):
+        yield ScenarioItem.from_parent(self, name='replay')
+
+
+class ScenarioItem(pytest.Item):
+    def setup(self):
+        self.config._pyqttester.setup()
+
+    def runtest(self):
+        config = self.config
+        options = ['--no-cache', '--timings='] + shlex.split(_option(config, 'options'))
+        result = replay(str(self.path), _option(config, 'main'), *options,
+                        qt=_option(config, 'qt'))
+        if result is None:
+            return
+        self.user_properties.extend((
+            ('events', len(result.latencies)),
+            ('wall_time', result.wall_time),
+            ('cpu_time', result.cpu_time),
+        ))
+        if result.latencies:
+            self.user_properties.extend(
+                ('latency_p{}'.format(p), percentile(result.latencies, p))
+                for p in (50, 90, 99, 100))
+        self.add_report_section(
+            'call', 'pyqttester timings',
+            '\n'.join('{}: {}'.format(*prop) for prop in self.user_properties) +
+            '\nper-event dispatch latencies (s): ' +
+            ' '.join('{:.4f}'.format(t) for t in result.latencies))
+
+    def repr_failure(self, excinfo):
+        if isinstance(excinfo.value, PyQtTesterError):
+            return 'Replaying scenario {} failed: {}'.format(self.path, excinfo.value)
+        return super().repr_failure(excinfo)
+
+    def reportinfo(self):
+        return self.path, None, 'scenario: {}'.format(self.path.name)
@@ -0,0 +1,134 @@
+"""
+Soak (stress) testing: replay scenarios in a loop inside a single app
+instance and track memory growth and latency drift across iterations.
+"""
+
+import os
+import gc
+import time
+import random
+import logging
+import tracemalloc
+from itertools import count
+from statistics import median
+
+from .timings import peak_rss, percentile
+
+log = logging.getLogger(__name__)
+
+# Number of top growing allocation sites to report
+N_TOP_ALLOCATIONS = 10
+
+
+def current_rss():
+    """Return current resident set size of this process in bytes"""
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        # Not on Linux; peak is the best we can do
+        return peak_rss()
+
+
+def slope(values):
+    """Return the least-squares slope of values per unit of their index"""
+    n = len(values)
+    if n < 2:
+        return 0.
+    mean_x, mean_y = (n - 1) / 2, sum(values) / n
+    return (sum((x - mean_x) * (y - mean_y) for x, y in enumerate(values)) /
+            sum((x - mean_x)**2 for x in range(n)))
+
+
+class Soak:
+    """
+    Plan of a soak run: replay the scenarios (in shuffled order if shuffle)
+    repeat times or until duration seconds have passed, sampling resource
+    usage after each iteration (i.e. a pass over all scenarios).
+    """
+    def __init__(self, files, repeat=None, duration=None, shuffle=False, seed=None):
+        self.files = files
+        self.repeat = repeat if repeat or duration else 1
+        self.duration = duration
+        self.random = random.Random(seed) if shuffle else None
+        self.samples = []
+        self._snapshots = []
+
+    def plan(self, latencies, count_widgets, qobject_type):
+        """
+        Yield the names of scenarios to replay in turn.
+
+        latencies is the list the replayer appends per-event dispatch times
+        to; count_widgets() returns the number of live widgets; qobject_type
+        is the QObject class whose live Python instances are counted.
+        """
+        tracemalloc.start()
+        # Also when the replay fails or quits before all iterations
+        try:
+            start = time.monotonic()
+            n_latencies = 0
+            for iteration in count(1):
+                names = [file.name for file in self.files]
+                if self.random:
+                    self.random.shuffle(names)
+                yield from names
+
+                gc.collect()
+                iteration_latencies = latencies[n_latencies:]
+                n_latencies = len(latencies)
+                sample = dict(
+                    iteration=iteration,
+                    time=time.monotonic() - start,
+                    rss=current_rss(),
+                    heap=tracemalloc.get_traced_memory()[0],
+                    widgets=count_widgets(),
+                    qobjects=sum(isinstance(obj, qobject_type)
+                                 for obj in gc.get_objects()),
+                    latency_p50=percentile(iteration_latencies, 50) or 0,
+                    latency_p90=percentile(iteration_latencies, 90) or 0)
+                self.samples.append(sample)
+                log.info('Soak iteration %d: %s', iteration, sample)
+                # Compare allocations against the end of the first (warm-up)
+                # iteration; keep only the first and the latest snapshot
+                snapshot = tracemalloc.take_snapshot().filter_traces(
+                    (tracemalloc.Filter(False, tracemalloc.__file__),
+                     tracemalloc.Filter(False, __file__)))
+                self._snapshots[1:] = [snapshot]
+
+                if self.repeat and iteration >= self.repeat:
+                    break
+                if self.duration and time.monotonic() - start >= self.duration:
+                    break
+        finally:
+            tracemalloc.stop()
+
+    def report(self):
+        """Print the growth of sampled quantities over iterations"""
+        if not self.samples:
+            return
+        # Skip the first, warm-up iteration when there are enough samples
+        samples = self.samples[1:] if len(self.samples) > 2 else self.samples
+        print('Soak: {} iterations in {:.1f} s'.format(
+            len(self.samples), self.samples[-1]['time']))
+        print('{:<20}{:>14}{:>14}{:>14}{:>16}'.format(
+            '', 'first', 'last', 'median', 'slope/iter'))
+        for key, title, scale in (('rss', 'RSS (MiB)', 2**-20),
+                                  ('heap', 'Python heap (MiB)', 2**-20),
+                                  ('widgets', 'Widgets', 1),
+                                  ('qobjects', 'QObjects', 1),
+                                  ('latency_p50', 'Latency p50 (ms)', 1e3),
+                                  ('latency_p90', 'Latency p90 (ms)', 1e3)):
+            values = [sample[key] * scale for sample in samples]
+            print('{:<20}{:>14.3f}{:>14.3f}{:>14.3f}{:>+16.4f}'.format(
+                title, values[0], values[-1], median(values), slope(values)))
+        if len(self._snapshots) == 2:
+            first, last = self._snapshots
+            growing = [stat for stat in last.compare_to(first, 'lineno')
+                       if stat.size_diff > 0][:N_TOP_ALLOCATIONS]
+            if growing:
+                print('Top growing allocation sites since the first iteration:')
+                for stat in growing:
+                    frame = stat.traceback[0]
+                    print('  {}:{}  {:+.1f} KiB ({:+d} blocks)'.format(
+                        frame.filename, frame.lineno,
+                        stat.size_diff / 1024, stat.count_diff))
@@ -0,0 +1,199 @@
+"""
+Historical timing store of scenario replays and detection of performance
+regressions against earlier replays of the same scenario.
+"""
+
+import os
+import sys
+import time
+import json
+import sqlite3
+import logging
+from statistics import median
+from xml.etree import ElementTree
+
+log = logging.getLogger(__name__)
+
+METRICS = ('wall_time', 'cpu_time', 'peak_rss',
+           'latency_p50', 'latency_p90', 'latency_p99', 'latency_max')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS replays (
+    id INTEGER PRIMARY KEY,
+    scenario TEXT NOT NULL,
+    time REAL NOT NULL,
+    qt TEXT,
+    pyqt_version TEXT,
+    n_events INTEGER,
+    wall_time REAL,
+    cpu_time REAL,
+    peak_rss INTEGER,
+    latency_p50 REAL,
+    latency_p90 REAL,
+    latency_p99 REAL,
+    latency_max REAL,
+    latencies TEXT
+);
+CREATE INDEX IF NOT EXISTS replays_scenario ON replays (scenario, time);
+'''
+
+
+def connect(path):
+    db = sqlite3.connect(path)
+    db.executescript(SCHEMA)
+    return db
+
+
+def percentile(values, p):
+    """Return the p-th (0-100) percentile of values by the nearest-rank method"""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, -(-len(values) * p // 100) - 1)]
+
+
+def peak_rss():
+    """Return peak resident set size of this process in bytes, or None"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on Mac OS
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def scenario_name(path):
+    """Return the name a scenario's timings are stored under: its file name,
+    which is the same wherever it is replayed from (e.g. distributed workers
+    replay from temporary directories)"""
+    return os.path.basename(path)
+
+
+def record(path, scenario, qt, pyqt_version, wall_time, cpu_time, latencies,
+           is_own_process=True):
+    """Append timings of a replay to the store at path. Peak RSS is that of
+    the whole process, so it is only stored if is_own_process, i.e. if the
+    replay was the only thing the process ran."""
+    row = dict(scenario=scenario_name(scenario),
+               time=time.time(),
+               qt=qt,
+               pyqt_version=pyqt_version,
+               n_events=len(latencies),
+               wall_time=wall_time,
+               cpu_time=cpu_time,
+               peak_rss=peak_rss() if is_own_process else None,
+               latency_p50=percentile(latencies, 50),
+               latency_p90=percentile(latencies, 90),
+               latency_p99=percentile(latencies, 99),
+               latency_max=max(latencies, default=None),
+               latencies=json.dumps(latencies))
+    log.info('Replay timings: wall %.3fs, cpu %.3fs, peak RSS %s B, '
+             'event latency p50/p90/p99 %s/%s/%s s',
+             wall_time, cpu_time, row['peak_rss'],
+             row['latency_p50'], row['latency_p90'], row['latency_p99'])
+    try:
+        with connect(path) as db:
+            db.execute('INSERT INTO replays ({}) VALUES ({})'.format(
+                ', '.join(row), ', '.join('?' * len(row))), tuple(row.values()))
+    except (sqlite3.Error, OSError) as e:
+        log.warning("Can't write timing store %s: %s", path, e)
+
+
+def compare_scenario(values, n_recent, n_baseline, threshold, min_change):
+    """
+    Compare the median of the last n_recent values against the preceding
+    n_baseline values (all ordered oldest first).
+
+    A change is significant if it exceeds both `threshold` robust standard
+    deviations (scaled median absolute deviation) of the baseline and
+    `min_change` relative to the baseline median.
+
+    Returns
+    -------
+    (baseline, recent, status): (float or None, float or None, str)
+        status is one of 'regression', 'improvement', 'ok', or
+        'no baseline' if there are too few baseline values.
+    """
+    recent = values[-n_recent:]
+    baseline = values[-n_recent - n_baseline:-n_recent]
+    if not recent or len(baseline) < 2:
+        return None, median(recent) if recent else None, 'no baseline'
+    base_median, recent_median = median(baseline), median(recent)
+    mad = 1.4826 * median(abs(v - base_median) for v in baseline)
+    allowed = max(threshold * mad, min_change * abs(base_median))
+    change = recent_median - base_median
+    status = ('regression' if change > allowed else
+              'improvement' if change < -allowed else
+              'ok')
+    return base_median, recent_median, status
+
+
+def write_junit(file, results):
+    suite = ElementTree.Element(
+        'testsuite',
+        name='pyqttester.timings',
+        tests=str(len(results)),
+        failures=str(sum(r['status'] == 'regression' for r in results)),
+        time=str(sum(r['wall_time'] or 0 for r in results)))
+    for result in results:
+        case = ElementTree.SubElement(
+            suite, 'testcase',
+            classname='pyqttester.timings',
+            name=result['scenario'],
+            time=str(result['wall_time'] or 0))
+        properties = ElementTree.SubElement(case, 'properties')
+        for metric in METRICS:
+            if result[metric] is not None:
+                ElementTree.SubElement(properties, 'property',
+                                       name=metric, value=str(result[metric]))
+        if result['status'] == 'regression':
+            failure = ElementTree.SubElement(
+                case, 'failure',
+                message='{} regressed from {:g} to {:g}'.format(
+                    result['metric'], result['baseline'], result['recent']))
+            failure.text = result['message']
+    ElementTree.ElementTree(suite).write(file, encoding='utf-8',
+                                         xml_declaration=True)
+
+
+def compare(args):
+    """Print the comparison of recent replays against the baseline; return
+    non-zero exit status if any scenario regressed"""
+    try:
+        db = connect(args.timings)
+    except (sqlite3.Error, OSError) as e:
+        log.error("Can't open timing store %s: %s", args.timings, e)
+        return 1
+    # Timings of different Qt versions aren't comparable
+    scenarios = db.execute(
+        'SELECT DISTINCT scenario, qt FROM replays ORDER BY scenario, qt').fetchall()
+    if args.scenarios:
+        scenarios = [(name, qt)
+                     for name in map(scenario_name, args.scenarios)
+                     for qt in [qt for other, qt in scenarios if other == name] or [None]]
+    results = []
+    for scenario, qt in scenarios:
+        rows = db.execute(
+            'SELECT {} FROM replays WHERE scenario = ? AND qt IS ? '
+            'ORDER BY time'.format(', '.join(METRICS)),
+            (scenario, qt)).fetchall()
+        if qt is not None:
+            scenario = '{} (Qt{})'.format(scenario, qt)
+        rows = [dict(zip(METRICS, row)) for row in rows]
+        values = [row[args.metric] for row in rows if row[args.metric] is not None]
+        baseline, recent, status = compare_scenario(
+            values, args.recent, args.baseline, args.threshold, args.min_change)
+        latest = rows[-1] if rows else dict.fromkeys(METRICS)
+        message = '{}: {} {} (baseline {}, recent {}, {} runs)'.format(
+            scenario, args.metric, status,
+            '-' if baseline is None else '{:g}'.format(baseline),
+            '-' if recent is None else '{:g}'.format(recent),
+            len(values))
+        results.append(dict(latest, scenario=scenario, metric=args.metric,
+                            baseline=baseline, recent=recent,
+                            status=status, message=message))
+        print(message)
+    if args.junit:
+        write_junit(args.junit, results)
+    return int(any(result['status'] == 'regression' for result in results))
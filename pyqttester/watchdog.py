@@ -0,0 +1,92 @@
+"""
+Watchdog that detects stalls of the GUI (main) thread during replay and
+reports where the main thread spends its time while stalled.
+"""
+
+import sys
+import time
+import logging
+import threading
+import traceback
+from collections import Counter
+
+log = logging.getLogger(__name__)
+
+# Number of hottest frames to report
+N_HOT_FRAMES = 10
+
+
+class Watchdog(threading.Thread):
+    """
+    Monitor the main thread's heartbeat (see beat()). When no beat comes for
+    longer than stall_after seconds, sample the main thread's Python stack
+    every interval seconds. Once the main thread recovers, report the hot
+    frames together with get_context(), e.g. the event being replayed. If it
+    doesn't recover in timeout seconds, report and call on_timeout().
+    """
+    def __init__(self, stall_after, interval, timeout, get_context, on_timeout):
+        super().__init__(name='pyqttester-watchdog', daemon=True)
+        self.stall_after = stall_after
+        self.interval = interval
+        self.timeout = timeout
+        self.get_context = get_context
+        self.on_timeout = on_timeout
+        self.main_ident = threading.main_thread().ident
+        self.last_beat = None
+        self.n_stalls = 0
+        self._stop_event = threading.Event()
+
+    def beat(self):
+        """Signal the main thread is alive (called from the main thread)"""
+        self.last_beat = time.monotonic()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def _sample(self):
+        frame = sys._current_frames().get(self.main_ident)
+        if frame is None:
+            return ()
+        return tuple((f.filename, f.lineno, f.name, f.line)
+                     for f in traceback.extract_stack(frame))
+
+    def _report(self, stalled, samples, level=logging.WARNING):
+        leaves = Counter(stack[-1] for stack in samples if stack)
+        stacks = Counter(samples)
+        lines = ['Main thread stalled for {:.1f} s while replaying: {}'.format(
+            stalled, self.get_context())]
+        if leaves:
+            lines.append('Hot frames ({} samples):'.format(len(samples)))
+            lines.extend('  {:>5} {}:{} in {}'.format(n, *frame[:3])
+                         for frame, n in leaves.most_common(N_HOT_FRAMES))
+            stack, n = stacks.most_common(1)[0]
+            lines.append('Most frequent stack ({} samples):'.format(n))
+            lines.extend('  ' + line.rstrip('\n')
+                         for line in traceback.format_list(stack))
+        log.log(level, '\n'.join(lines))
+
+    def run(self):
+        samples = []
+        stall_start = None
+        while not self._stop_event.wait(self.interval if samples else
+                                        min(self.interval * 10, self.stall_after)):
+            last_beat = self.last_beat
+            if last_beat is None:
+                # Not armed until the first beat
+                continue
+            stalled = time.monotonic() - last_beat
+            if stalled < self.stall_after:
+                if samples:
+                    self.n_stalls += 1
+                    self._report(time.monotonic() - stall_start, samples)
+                    samples = []
+                continue
+            if not samples:
+                stall_start = last_beat
+            samples.append(self._sample())
+            if stalled >= self.timeout:
+                self._report(stalled, samples, logging.ERROR)
+                log.error('Main thread stalled for longer than %g s; aborting',
+                          self.timeout)
+                self.on_timeout()
+                return
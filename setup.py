@@ -23,5 +23,8 @@ if __name__ == '__main__':
             'console_scripts': (
                 'PyQtTester = pyqttester:main',
             ),
+            'pytest11': (
+                'pyqttester = pyqttester.pytest_plugin',
+            ),
         }
     )